@@ -0,0 +1,46 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""
+This module defines the client settings used by the core API handlers that reuse
+pooled connections across warm invocations.
+"""
+
+import socket
+import redis
+from botocore import config
+
+
+def boto_config(solution_id):
+    """
+    Return a botocore config with a larger connection pool, standard retries and TCP keepalive
+    """
+    return config.Config(
+        user_agent_extra=solution_id,
+        max_pool_connections=50,
+        retries={'mode': 'standard', 'total_max_attempts': 3},
+        tcp_keepalive=True
+    )
+
+
+def redis_client(host, port, password):
+    """
+    Return a Redis client whose TCP and TLS session is kept alive across warm invocations
+    instead of being renegotiated after each thaw
+    """
+    pool = redis.ConnectionPool(
+        connection_class=redis.SSLConnection,
+        host=host,
+        port=port,
+        password=password,
+        decode_responses=True,
+        socket_keepalive=True,
+        socket_keepalive_options={
+            socket.TCP_KEEPIDLE: 60,
+            socket.TCP_KEEPINTVL: 30,
+            socket.TCP_KEEPCNT: 3
+        },
+        health_check_interval=30,
+        max_connections=4
+    )
+    return redis.Redis(connection_pool=pool)
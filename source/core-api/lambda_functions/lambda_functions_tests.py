@@ -9,7 +9,7 @@ This module is the unit test for the core API Lambda functions.
 import os
 import unittest
 import time
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import Mock, patch, MagicMock, ANY
 
 import json
 from botocore.response import StreamingBody
@@ -487,26 +487,74 @@ class CoreApiTestCase(unittest.TestCase):
         body = json.loads(response['body'])
         self.assertEqual(body["error"], self.invalid_event_id_msg)
 
-    @patch.object(reset_initial_state.rc, 'getset', return_value=0)
-    @patch.object(reset_initial_state.ddb_client, 'describe_table', return_value={})
-    @patch.object(reset_initial_state.ddb_client, 'delete_table', return_value={})
-    @patch.object(reset_initial_state.ddb_client, 'get_waiter', return_value=MagicMock().wait)
-    @patch.object(reset_initial_state.ddb_client, 'create_table', return_value={})
     @patch.object(reset_initial_state.rc, 'set', return_value=0)
-    def test_reset_initial_state(self, mock_rc_getset, mock_describe, mock_delete, mock_waiter, mock_create, mock_rc_set):
+    @patch.object(reset_initial_state.ddb_client, 'create_table', return_value={})
+    @patch.object(reset_initial_state.ddb_client, 'get_waiter', return_value=MagicMock().wait)
+    @patch.object(reset_initial_state.ddb_client, 'delete_table', return_value={})
+    @patch.object(reset_initial_state.ddb_client, 'describe_table', return_value={})
+    @patch.object(reset_initial_state.ddb_client, 'batch_write_item', return_value={})
+    @patch.object(reset_initial_state.ddb_client, 'get_paginator')
+    @patch.object(reset_initial_state.rc, 'pipeline')
+    def test_reset_initial_state(self, mock_rc_pipeline, mock_paginator, mock_batch_write, mock_describe, mock_delete, mock_waiter, mock_create, mock_rc_set):
         """
         This function tests the reset_initial_state lambda function
         """
-        # event_id is valid
+        # two pages per scan segment
+        mock_paginator.return_value.paginate.return_value = [
+            {"Items": [{"request_id": {"S": self.request_id}}]},
+            {"Items": [{"request_id": {"S": self.invalid_id}}]}
+        ]
+
+        # event_id is valid, table items are purged
         mock_event_200 = {"event_id": self.event_id}
         response = reset_initial_state.lambda_handler(mock_event_200, None)
         self.assertEqual(response["statusCode"], 200)
+        self.assertEqual(mock_paginator.return_value.paginate.call_count, 3 * reset_initial_state.SCAN_SEGMENTS)
+        self.assertEqual(mock_batch_write.call_count, 3 * reset_initial_state.SCAN_SEGMENTS * 2)
+        mock_pipe = mock_rc_pipeline.return_value.__enter__.return_value
+        mock_pipe.set.assert_called_once_with(reset_initial_state.RESET_IN_PROGRESS, 1)
+        mock_pipe.mset.assert_called_once()
+        self.assertTrue(all(value == 0 for value in mock_pipe.mset.call_args[0][0].values()))
+        mock_pipe.execute.assert_called_once()
+        mock_delete.assert_not_called()
+        mock_create.assert_not_called()
+
+        # event_id is valid, tables are deleted and recreated
+        with patch.object(reset_initial_state, 'FULL_RESET', True):
+            response = reset_initial_state.lambda_handler(mock_event_200, None)
+            self.assertEqual(response["statusCode"], 200)
+            self.assertEqual(mock_delete.call_count, 3)
+            self.assertEqual(mock_create.call_count, 3)
+            mock_waiter.return_value.wait.assert_called_with(TableName=ANY, WaiterConfig=reset_initial_state.WAITER_CONFIG)
+
+        # unprocessed deletes are resubmitted with backoff
+        unprocessed = {"token_table": [{"DeleteRequest": {"Key": {"request_id": {"S": self.request_id}}}}]}
+        with patch.object(reset_initial_state, 'sleep') as mock_sleep:
+            mock_batch_write.reset_mock()
+            mock_batch_write.side_effect = [{"UnprocessedItems": unprocessed}, {"UnprocessedItems": {}}]
+            reset_initial_state.delete_items("token_table", [{"request_id": {"S": self.request_id}}])
+            self.assertEqual(mock_batch_write.call_count, 2)
+            mock_batch_write.assert_called_with(RequestItems=unprocessed)
+            mock_sleep.assert_called_once()
+
+            # gives up once the attempts are exhausted
+            mock_batch_write.reset_mock()
+            mock_batch_write.side_effect = None
+            mock_batch_write.return_value = {"UnprocessedItems": unprocessed}
+            with self.assertRaises(Exception):
+                reset_initial_state.delete_items("token_table", [{"request_id": {"S": self.request_id}}])
+            self.assertEqual(mock_batch_write.call_count, reset_initial_state.MAX_BATCH_WRITE_ATTEMPTS)
 
         # invalid event_id
         mock_event_400 = {"event_id": self.invalid_id}
         response = reset_initial_state.lambda_handler(mock_event_400, None)
         self.assertEqual(response["statusCode"], 400)
 
+        # missing or non-string event_id
+        for mock_event_400 in [{}, {"event_id": None}, {"event_id": ["abc123"]}]:
+            response = reset_initial_state.lambda_handler(mock_event_400, None)
+            self.assertEqual(response["statusCode"], 400)
+
     @patch.object(update_session.rc, 'incr', return_value=1)
     @patch.object(update_session.ddb_table, 'update_item',
                   return_value={"Items": [{"request_id": "fe7a5f04-6ff0-4bd6-9c31-52088cc4e73a"}]})
@@ -609,19 +657,28 @@ class CoreApiTestCase(unittest.TestCase):
                 self.assertTrue(isinstance(json.loads(response['body'])["expires_in"], int))
 
 
-    @patch.object(set_max_queue_position_expired.ddb_table_serving_counter_issued_at, 'query', 
-        return_value= { 'Items': [
-                {'serving_counter' : 10, 'queue_positions_served': 8, 'issue_time': int(time.time()) - 1000},
-                {'serving_counter' : 25, 'queue_positions_served': 11, 'issue_time': int(time.time()) - 500 }
-            ] }
-        )
-    def test_set_max_queue_position_expired(self, mock_table):
+    @patch.object(set_max_queue_position_expired.ddb_client, 'query')
+    def test_set_max_queue_position_expired(self, mock_query):
         """
         This function tests the get_queue_position_expiry_time lambda function
         """
+        serving_counter_items = [
+            {'serving_counter': {'N': '10'}, 'queue_positions_served': {'N': '8'}, 'issue_time': {'N': str(int(time.time()) - 1000)}},
+            {'serving_counter': {'N': '25'}, 'queue_positions_served': {'N': '11'}, 'issue_time': {'N': str(int(time.time()) - 500)}}
+        ]
+        queue_position_items = []
+        def mock_ddb_query(**kwargs):
+            if kwargs['TableName'] == os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"]:
+                return {'Items': serving_counter_items}
+            return {'Items': queue_position_items}
+        mock_query.side_effect = mock_ddb_query
+
         mock_redis_cache = {'max_queue_position_expired': '0', 'serving_counter': '0' }
-        def mock_get(key):
-            return mock_redis_cache[key]
+        def mock_evalsha(sha, numkeys, *keys):
+            # mirrors the read_counters script
+            if int(mock_redis_cache.get(keys[0]) or 0) != 0:
+                return None
+            return [mock_redis_cache.get(key) for key in keys[1:numkeys]]
 
         def mock_set(key, value):
             if mock_redis_cache:
@@ -636,10 +693,31 @@ class CoreApiTestCase(unittest.TestCase):
                 return _value
             return None
 
+        class MockPipeline:
+            """
+            Queues commands and runs them against the mock cache on execute
+            """
+            def __init__(self):
+                self.commands = []
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def set(self, key, value):
+                self.commands.append(lambda: mock_set(key, value))
+
+            def incrby(self, key, value):
+                self.commands.append(lambda: mock_incr(key, value))
+
+            def execute(self):
+                return [command() for command in self.commands]
+
         set_max_queue_position_expired.rc = MagicMock()
-        set_max_queue_position_expired.rc.get = Mock(side_effect=mock_get)
-        set_max_queue_position_expired.rc.set = Mock(side_effect=mock_set)
-        set_max_queue_position_expired.rc.incrby = Mock(side_effect=mock_incr)
+        set_max_queue_position_expired.rc.evalsha = Mock(side_effect=mock_evalsha)
+        set_max_queue_position_expired.rc.pipeline = Mock(side_effect=lambda transaction=True: MockPipeline())
 
         mock_event = {'id': '3475893474', 'detail-type': 'Scheduled Event', 'source': 'aws.events', 'account': 'dummy123' }
 
@@ -650,31 +728,62 @@ class CoreApiTestCase(unittest.TestCase):
             mocked_print.assert_called_with('Reset in progress. Skipping execution')
         mock_redis_cache['reset_in_progress'] = 0
 
-        # no queue positions eligible
-        with patch.object(set_max_queue_position_expired.ddb_table_queue_position_entry_time, 'query', return_value={'Items': [] }):
-            with patch('builtins.print') as mocked_print:
-                mock_redis_cache['queue_counter'] = 6
-                set_max_queue_position_expired.lambda_handler(mock_event, None)
-                mocked_print.assert_called_with('No queue postions items eligible')
+        # serving counter items beyond the queue counter, queue positions aren't queried
+        mock_redis_cache['queue_counter'] = 6
+        mock_query.reset_mock()
+        set_max_queue_position_expired.lambda_handler(mock_event, None)
+        mock_query.assert_called_once()
+        self.assertEqual(mock_redis_cache['max_queue_position_expired'], '0')
 
-        # # set max queue position expired (no svc increment, set os.environ INCR_SVC_ON_QUEUE_POS_EXPIRY to false)
-        # with patch.object(set_max_queue_position_expired.ddb_table_queue_position_entry_time, 'query', 
-        #     return_value={'Items': [{"queue_position": 12, "event_id": "abc123", "entry_time": int(time.time()) - 150, "status": 1}] }):
-        #     with patch.object(set_max_queue_position_expired, 'incr_serving_counter') as mock_method:
-        #         set_max_queue_position_expired.lambda_handler(mock_event, None)
-        #         self.assertEqual(mock_redis_cache['max_queue_position_expired'], 25)
-        #         mock_method.assert_not_called()
+        # no queue positions eligible
+        with patch('builtins.print') as mocked_print:
+            mock_redis_cache['queue_counter'] = 30
+            set_max_queue_position_expired.lambda_handler(mock_event, None)
+            mocked_print.assert_called_with('No queue postions items eligible')
 
         # set max queue position expired (with svc increment)
-        with patch.object(set_max_queue_position_expired.ddb_table_queue_position_entry_time, 'query', 
-            return_value={'Items': [{"queue_position": 12, "event_id": "abc123", "entry_time": int(time.time()) - 150, "status": 1}] }):
-            with patch.object(set_max_queue_position_expired.ddb_table_serving_counter_issued_at, 'put_item', return_value=None) as mock_svc_table:
-                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value=None) as mock_events_client:
+        queue_position_items.append({"queue_position": {'N': '12'}, "event_id": {'S': "abc123"}, "entry_time": {'N': str(int(time.time()) - 150)}, "status": {'N': '1'}})
+        with patch.object(set_max_queue_position_expired.ddb_client, 'put_item', return_value=None) as mock_svc_table:
+            with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []}) as mock_events_client:
+                set_max_queue_position_expired.lambda_handler(mock_event, None)
+                self.assertEqual(mock_redis_cache['max_queue_position_expired'], 25)
+                self.assertEqual(mock_redis_cache['serving_counter'], 2 + 4)      
+                mock_events_client.assert_called_once()
+                self.assertEqual(len(mock_events_client.call_args[1]['Entries']), 2)
+                mock_svc_table.assert_called()  
+
+        # set max queue position expired (no svc increment)
+        mock_redis_cache.update({'max_queue_position_expired': '0', 'serving_counter': '0'})
+        with patch.object(set_max_queue_position_expired, 'INCR_SVC_ON_QUEUE_POS_EXPIRY', False):
+            with patch.object(set_max_queue_position_expired, 'record_serving_counter_incr') as mock_method:
+                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []}) as mock_events_client:
                     set_max_queue_position_expired.lambda_handler(mock_event, None)
                     self.assertEqual(mock_redis_cache['max_queue_position_expired'], 25)
-                    self.assertEqual(mock_redis_cache['serving_counter'], 2 + 4)      
-                    mock_events_client.assert_called()
-                    mock_svc_table.assert_called()  
+                    self.assertEqual(mock_redis_cache['serving_counter'], '0')
+                    mock_method.assert_not_called()
+                    mock_events_client.assert_not_called()
+
+        # set max queue position expired (with svc increment, events disabled)
+        mock_redis_cache.update({'max_queue_position_expired': '0', 'serving_counter': '0'})
+        with patch.object(set_max_queue_position_expired, 'EMIT_COUNTER_EVENTS', False):
+            with patch.object(set_max_queue_position_expired.ddb_client, 'put_item', return_value=None) as mock_svc_table:
+                with patch.object(set_max_queue_position_expired.events_client, 'put_events', return_value={'FailedEntryCount': 0, 'Entries': []}) as mock_events_client:
+                    set_max_queue_position_expired.lambda_handler(mock_event, None)
+                    self.assertEqual(mock_redis_cache['serving_counter'], 2 + 4)
+                    mock_svc_table.assert_called()
+                    mock_events_client.assert_not_called()
+
+        # events for increments already made are sent when a later iteration fails, rejected entries are logged
+        mock_redis_cache.update({'max_queue_position_expired': '0', 'serving_counter': '0'})
+        with patch.object(set_max_queue_position_expired.ddb_client, 'put_item', side_effect=[None, Exception]):
+            with patch.object(set_max_queue_position_expired.events_client, 'put_events',
+                return_value={'FailedEntryCount': 1, 'Entries': [{'ErrorCode': 'InternalFailure'}]}) as mock_events_client:
+                with patch('builtins.print') as mocked_print:
+                    with self.assertRaises(Exception):
+                        set_max_queue_position_expired.lambda_handler(mock_event, None)
+                    mock_events_client.assert_called_once()
+                    self.assertEqual(len(mock_events_client.call_args[1]['Entries']), 1)
+                    self.assertTrue(mocked_print.call_args[0][0].startswith('Failed to put 1 events'))
         
 if __name__ == '__main__':
     unittest.main()
@@ -5,13 +5,14 @@
 This module is the used to reset the counters and DynamoDB table used by the core API.
 """
 
-import redis
 import json
+import hmac
 import os
 import boto3
-from botocore import config
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from connections import boto_config, redis_client
 from counters import QUEUE_COUNTER, SERVING_COUNTER, TOKEN_COUNTER, ABANDONED_SESSION_COUNTER, COMPLETED_SESSION_COUNTER, MAX_QUEUE_POSITION_EXPIRED, RESET_IN_PROGRESS
-from vwr.common.sanitize import deep_clean
 
 TOKEN_TABLE = os.environ["TOKEN_TABLE"]
 EVENT_ID = os.environ["EVENT_ID"]
@@ -21,16 +22,29 @@ SOLUTION_ID = os.environ['SOLUTION_ID']
 SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
 QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
 SERVING_COUNTER_ISSUEDAT_TABLE = os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"]
+# delete and recreate the tables instead of purging their items
+FULL_RESET = os.environ.get("FULL_RESET", "false").lower() == 'true'
+# parallel scan segments per table when purging
+SCAN_SEGMENTS = 4
+# BatchWriteItem accepts at most 25 requests
+MAX_BATCH_WRITE_ITEMS = 25
+# BatchWriteItem attempts per batch and the backoff between them, in seconds
+MAX_BATCH_WRITE_ATTEMPTS = 8
+BATCH_WRITE_BASE_DELAY = 0.05
+BATCH_WRITE_MAX_DELAY = 2
 
-user_agent_extra = {"user_agent_extra": SOLUTION_ID}
-user_config = config.Config(**user_agent_extra)
+user_config = boto_config(SOLUTION_ID)
 boto_session = boto3.session.Session()
 region = boto_session.region_name
 ddb_client = boto3.client('dynamodb', endpoint_url=f"https://dynamodb.{region}.amazonaws.com", config=user_config)
 secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f"https://secretsmanager.{region}.amazonaws.com")
+
 response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
 redis_auth = response.get("SecretString")
-rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+rc = redis_client(REDIS_HOST, REDIS_PORT, redis_auth)
+# poll table status every 2 seconds instead of the 20 second waiter default,
+# giving up after 3 minutes
+WAITER_CONFIG = {'Delay': 2, 'MaxAttempts': 90}
 
 def lambda_handler(event, _):
     """
@@ -38,84 +52,53 @@ def lambda_handler(event, _):
     """
 
     print(event)
-    client_event_id = deep_clean(event['event_id'])
+    client_event_id = event.get('event_id')
     response = {}
     headers = {
         'Content-Type': 'application/json',
         'Access-Control-Allow-Origin': '*'
     }
 
-    if EVENT_ID == client_event_id:
-        rc.getset(RESET_IN_PROGRESS, 1)
+    # compare the raw value in constant time; it is never used beyond this check, so it doesn't need sanitizing
+    if isinstance(client_event_id, str) and hmac.compare_digest(client_event_id.encode(), EVENT_ID.encode()):
+        # flag the reset and zero the counters in a single round trip
+        with rc.pipeline(transaction=False) as pipe:
+            pipe.set(RESET_IN_PROGRESS, 1)
+            pipe.mset({
+                SERVING_COUNTER: 0,
+                QUEUE_COUNTER: 0,
+                TOKEN_COUNTER: 0,
+                COMPLETED_SESSION_COUNTER: 0,
+                ABANDONED_SESSION_COUNTER: 0,
+                MAX_QUEUE_POSITION_EXPIRED: 0
+            })
+            pipe.execute()
         print('Reset in progress')
-
-        # reset counters
-        rc.getset(SERVING_COUNTER, 0)
-        rc.getset(QUEUE_COUNTER, 0)
-        rc.getset(TOKEN_COUNTER, 0)
-        rc.getset(COMPLETED_SESSION_COUNTER, 0)
-        rc.getset(ABANDONED_SESSION_COUNTER, 0)
-        rc.getset(MAX_QUEUE_POSITION_EXPIRED, 0)
         print("Counters reset")
 
-        try:                       
-            response = ddb_client.delete_table(TableName=TOKEN_TABLE)
-            waiter = ddb_client.get_waiter('table_not_exists')
-            # wait for table to get deleted
-            waiter.wait(TableName=TOKEN_TABLE)
-            print("Token table deleted")
-            # recreate table
-            create_token_table()
-            waiter = ddb_client.get_waiter('table_exists')
-            # wait for table to get created
-            waiter.wait(TableName=TOKEN_TABLE)
-            print("Token table recreated")
-            # enable PITR
-            ddb_client.update_continuous_backups(
-                TableName=TOKEN_TABLE,
-                PointInTimeRecoverySpecification={
-                    'PointInTimeRecoveryEnabled': True
-                }
-            )
-
-            response = ddb_client.delete_table(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
-            waiter = ddb_client.get_waiter('table_not_exists')
-            # wait for table to get deleted
-            waiter.wait(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
-            print("QueuePositionEntryTimeTable table deleted")
-            # recreate table
-            create_queueposition_issuedat_table()
-            waiter = ddb_client.get_waiter('table_exists')
-            # wait for table to get created
-            waiter.wait(TableName=QUEUE_POSITION_ENTRYTIME_TABLE)
-            print("QueuePositionEntryTimeTable recreated")
-            # enable PITR
-            ddb_client.update_continuous_backups(
-                TableName=QUEUE_POSITION_ENTRYTIME_TABLE,
-                PointInTimeRecoverySpecification={
-                    'PointInTimeRecoveryEnabled': True
+        try:
+            # tables are independent, so reset them concurrently
+            if FULL_RESET:
+                # only needed when the table schemas change
+                tables = {
+                    TOKEN_TABLE: create_token_table,
+                    QUEUE_POSITION_ENTRYTIME_TABLE: create_queueposition_issuedat_table,
+                    SERVING_COUNTER_ISSUEDAT_TABLE: create_servingcounter_issuedat_table
                 }
-            )
-
-            response = ddb_client.delete_table(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
-            waiter = ddb_client.get_waiter('table_not_exists')
-            # wait for table to get deleted
-            waiter.wait(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
-            print("ServingCounterIssuedAt table deleted")
-            # recreate table
-            create_servingcounter_issuedat_table()
-            waiter = ddb_client.get_waiter('table_exists')
-            # wait for table to get created
-            waiter.wait(TableName=SERVING_COUNTER_ISSUEDAT_TABLE)
-            print("ServingCounterIssuedAt recreated")
-            # enable PITR
-            ddb_client.update_continuous_backups(
-                TableName=SERVING_COUNTER_ISSUEDAT_TABLE,
-                PointInTimeRecoverySpecification={
-                    'PointInTimeRecoveryEnabled': True
+                with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+                    # consume the results so any exception is re-raised here
+                    list(executor.map(recreate_table, tables.keys(), tables.values()))
+                print("DynamoDB tables recreated")
+            else:
+                table_keys = {
+                    TOKEN_TABLE: ['request_id'],
+                    QUEUE_POSITION_ENTRYTIME_TABLE: ['request_id'],
+                    SERVING_COUNTER_ISSUEDAT_TABLE: ['event_id', 'serving_counter']
                 }
-            )
-            print("DynamoDB tables recreated")
+                with ThreadPoolExecutor(max_workers=len(table_keys)) as executor:
+                    # consume the results so any exception is re-raised here
+                    list(executor.map(purge_table, table_keys.keys(), table_keys.values()))
+                print("DynamoDB tables purged")
             
             rc.set(RESET_IN_PROGRESS, 0)
             print('Reset completed')
@@ -139,6 +122,76 @@ def lambda_handler(event, _):
     return response
 
 
+def purge_table(table_name, key_attrs):
+    """
+    Delete every item in table_name, keeping the table and its configuration
+    """
+    with ThreadPoolExecutor(max_workers=SCAN_SEGMENTS) as executor:
+        # consume the results so any exception is re-raised here
+        list(executor.map(lambda segment: purge_table_segment(table_name, key_attrs, segment), range(SCAN_SEGMENTS)))
+    print(f"{table_name} table purged")
+
+
+def purge_table_segment(table_name, key_attrs, segment):
+    """
+    Delete the items in one segment of a parallel scan of table_name
+    """
+    paginator = ddb_client.get_paginator('scan')
+    pages = paginator.paginate(
+        TableName=table_name,
+        Segment=segment,
+        TotalSegments=SCAN_SEGMENTS,
+        # only the key attributes are needed to delete an item
+        ProjectionExpression=', '.join(f'#k{index}' for index in range(len(key_attrs))),
+        ExpressionAttributeNames={f'#k{index}': key_attr for index, key_attr in enumerate(key_attrs)},
+        PaginationConfig={'PageSize': 1000}
+    )
+    for page in pages:
+        keys = page['Items']
+        for index in range(0, len(keys), MAX_BATCH_WRITE_ITEMS):
+            delete_items(table_name, keys[index:index + MAX_BATCH_WRITE_ITEMS])
+
+
+def delete_items(table_name, keys):
+    """
+    Delete the items with the given keys from table_name, resubmitting any unprocessed deletes
+    """
+    request_items = {table_name: [{'DeleteRequest': {'Key': key}} for key in keys]}
+    for attempt in range(MAX_BATCH_WRITE_ATTEMPTS):
+        if attempt:
+            # back off exponentially before resubmitting, unprocessed items usually mean the table is throttling
+            sleep(min(BATCH_WRITE_BASE_DELAY * 2 ** attempt, BATCH_WRITE_MAX_DELAY))
+        response = ddb_client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems')
+        if not request_items:
+            return
+    raise Exception(f"{table_name} deletes still unprocessed after {MAX_BATCH_WRITE_ATTEMPTS} attempts")
+
+
+def recreate_table(table_name, create_table):
+    """
+    Delete table_name, recreate it using the create_table function and re-enable PITR
+    """
+    ddb_client.delete_table(TableName=table_name)
+    waiter = ddb_client.get_waiter('table_not_exists')
+    # wait for table to get deleted
+    waiter.wait(TableName=table_name, WaiterConfig=WAITER_CONFIG)
+    print(f"{table_name} table deleted")
+    # recreate table
+    create_table()
+    waiter = ddb_client.get_waiter('table_exists')
+    # wait for table to get created
+    waiter.wait(TableName=table_name, WaiterConfig=WAITER_CONFIG)
+    print(f"{table_name} table recreated")
+    # enable PITR
+    ddb_client.update_continuous_backups(
+        TableName=table_name,
+        PointInTimeRecoverySpecification={
+            'PointInTimeRecoveryEnabled': True
+        }
+    )
+
+
 def create_token_table():
     """
     Create TOKEN_TABLE
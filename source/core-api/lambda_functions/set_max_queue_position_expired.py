@@ -8,11 +8,11 @@ It sets the MAX_QUEUE_POSITION_EXPIRED value and optionally increments the servi
 
 import boto3
 import os
-import redis
 import json
-from botocore import config
 from time import time
-from boto3.dynamodb.conditions import Key
+from itertools import takewhile
+from concurrent.futures import ThreadPoolExecutor
+from connections import boto_config, redis_client
 from counters import MAX_QUEUE_POSITION_EXPIRED, QUEUE_COUNTER, RESET_IN_PROGRESS, SERVING_COUNTER
 
 SECRET_NAME_PREFIX = os.environ["STACK_NAME"]
@@ -21,42 +21,75 @@ EVENT_ID = os.environ["EVENT_ID"]
 REDIS_HOST = os.environ["REDIS_HOST"]
 REDIS_PORT = os.environ["REDIS_PORT"]
 QUEUE_POSITION_ENTRYTIME_TABLE = os.environ["QUEUE_POSITION_ENTRYTIME_TABLE"]
-QUEUE_POSITION_EXPIRY_PERIOD = os.environ["QUEUE_POSITION_EXPIRY_PERIOD"]
+QUEUE_POSITION_EXPIRY_PERIOD = int(os.environ["QUEUE_POSITION_EXPIRY_PERIOD"])
 SERVING_COUNTER_ISSUEDAT_TABLE = os.environ["SERVING_COUNTER_ISSUEDAT_TABLE"]
-INCR_SVC_ON_QUEUE_POS_EXPIRY = os.environ["INCR_SVC_ON_QUEUE_POS_EXPIRY"]
+INCR_SVC_ON_QUEUE_POS_EXPIRY = os.environ["INCR_SVC_ON_QUEUE_POS_EXPIRY"].lower() == 'true'
 EVENT_BUS_NAME = os.environ["EVENT_BUS_NAME"]
-
-user_agent_extra = {"user_agent_extra": SOLUTION_ID}
-user_config = config.Config(**user_agent_extra)
+# set to false when nothing consumes the automatic_serving_counter_incr events
+EMIT_COUNTER_EVENTS = os.environ.get("EMIT_COUNTER_EVENTS", "true").lower() == 'true'
+# queue position queries issued concurrently per window, well within the botocore connection pool
+MAX_QUERY_WORKERS = 10
+# EventBridge accepts at most 10 entries per PutEvents request
+MAX_EVENT_ENTRIES = 10
+# prebuilt query parameters, only ExpressionAttributeValues are set per call;
+# the projections limit the results to the attributes the handler reads
+SERVING_COUNTER_QUERY = {
+    'TableName': SERVING_COUNTER_ISSUEDAT_TABLE,
+    'KeyConditionExpression': 'event_id = :event_id AND serving_counter > :serving_counter',
+    'ProjectionExpression': 'serving_counter, issue_time, queue_positions_served'
+}
+QUEUE_POSITION_QUERY = {
+    'TableName': QUEUE_POSITION_ENTRYTIME_TABLE,
+    'IndexName': 'QueuePositionIndex',
+    'KeyConditionExpression': 'queue_position = :queue_position',
+    'ProjectionExpression': 'entry_time'
+}
+
+user_config = boto_config(SOLUTION_ID)
 boto_session = boto3.session.Session()
 region = boto_session.region_name
-ddb_resource = boto3.resource('dynamodb', endpoint_url=f'https://dynamodb.{region}.amazonaws.com', config=user_config)
-ddb_table_queue_position_entry_time = ddb_resource.Table(QUEUE_POSITION_ENTRYTIME_TABLE)
-ddb_table_serving_counter_issued_at = ddb_resource.Table(SERVING_COUNTER_ISSUEDAT_TABLE)
+# the low-level client avoids the resource layer's per-call expression building and type (de)serialization
+ddb_client = boto3.client('dynamodb', endpoint_url=f'https://dynamodb.{region}.amazonaws.com', config=user_config)
 secrets_client = boto3.client('secretsmanager', config=user_config, endpoint_url=f'https://secretsmanager.{region}.amazonaws.com')
+
 response = secrets_client.get_secret_value(SecretId=f"{SECRET_NAME_PREFIX}/redis-auth")
 redis_auth = response.get("SecretString")
-rc = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, ssl=True, decode_responses=True, password=redis_auth)
+rc = redis_client(REDIS_HOST, REDIS_PORT, redis_auth)
 events_client = boto3.client('events', endpoint_url=f'https://events.{region}.amazonaws.com', config=user_config)
+# returns nil while a reset is in progress, otherwise the values of the remaining keys;
+# redis-py runs it with EVALSHA and only sends the script body if the server doesn't have it cached
+read_counters = rc.register_script("""
+local reset_in_progress = redis.call('GET', KEYS[1])
+if reset_in_progress and reset_in_progress ~= '0' then
+    return nil
+end
+return {redis.call('GET', KEYS[2]), redis.call('GET', KEYS[3]), redis.call('GET', KEYS[4])}
+""")
 
 def lambda_handler(event, _):
     """
     This function is the entry handler for Lambda.
     """
     print(event)
-    if int(rc.get(RESET_IN_PROGRESS)) != 0:
+    # check the reset flag and read the counters atomically in a single round trip
+    counters = read_counters(keys=[RESET_IN_PROGRESS, MAX_QUEUE_POSITION_EXPIRED, SERVING_COUNTER, QUEUE_COUNTER], client=rc)
+    if counters is None:
         print('Reset in progress. Skipping execution')
         return
 
+    # missing counters are treated as 0
+    max_queue_position_expired, current_serving_counter_position, queue_counter = (int(value or 0) for value in counters)
+
     current_time = int(time())
-    max_queue_position_expired = int(rc.get(MAX_QUEUE_POSITION_EXPIRED))
-    current_serving_counter_position = int(rc.get(SERVING_COUNTER))
-    queue_counter = int(rc.get(QUEUE_COUNTER))
     print(f'Queue counter: {queue_counter}. Max position expired: {max_queue_position_expired}. Serving counter: {current_serving_counter_position}')
 
     # find items in the serving counter table that are greater than the max queue position expired
-    response = ddb_table_serving_counter_issued_at.query(
-        KeyConditionExpression=Key('event_id').eq(EVENT_ID) & Key('serving_counter').gt(max_queue_position_expired),
+    response = ddb_client.query(
+        **SERVING_COUNTER_QUERY,
+        ExpressionAttributeValues={
+            ':event_id': {'S': EVENT_ID},
+            ':serving_counter': {'N': str(max_queue_position_expired)}
+        }
     )
     serving_counter_items = response['Items']
 
@@ -64,50 +97,104 @@ def lambda_handler(event, _):
         print('No serving counter items eligible')
         return
 
+    # convert the number attributes returned by DynamoDB once, as (serving_counter, issue_time, queue_positions_served)
+    # items are ordered by serving counter, so stop at the first one issued within the expiry period
+    # or beyond the queue counter; neither it nor any later item can have an expired queue position
+    serving_counter_entries = list(takewhile(
+        lambda entry: current_time - entry[1] >= QUEUE_POSITION_EXPIRY_PERIOD and entry[0] <= queue_counter,
+        ((int(item['serving_counter']['N']), int(item['issue_time']['N']), int(item['queue_positions_served']['N'])) for item in serving_counter_items)
+    ))
+
     # set previous serving counter to max queue position expired
     previous_serving_counter_position = max_queue_position_expired
+    # serving counter increment events, sent in batches of up to MAX_EVENT_ENTRIES
+    event_entries = []
+
+    try:
+        for (serving_counter_item_position, serving_counter_item_issue_time, queue_positions_served), queue_item_entry_time in with_queue_entry_times(serving_counter_entries):
+
+            if queue_item_entry_time is None:
+                print('No queue postions items eligible')
+                break
 
-    for serving_counter_item in serving_counter_items:
-
-        serving_counter_item_position = int(serving_counter_item['serving_counter'])
-        serving_counter_item_issue_time = int(serving_counter_item['issue_time'])
-        
-        # query queue position table for corresponding serving counter item position
-        response = ddb_table_queue_position_entry_time.query(
-            KeyConditionExpression=Key('queue_position').eq(serving_counter_item_position),
-            IndexName='QueuePositionIndex',
-        )
-        queue_position_items = response['Items']
-        
-        if not queue_position_items:
-            print('No queue postions items eligible')
-            break
-        
-        queue_item_entry_time = int(queue_position_items[0]['entry_time'])
-        queue_time = max(queue_item_entry_time, serving_counter_item_issue_time)
-
-        # if time in queue has not exceeded expiry period, we can stop checking
-        if current_time - queue_time < int(QUEUE_POSITION_EXPIRY_PERIOD):
-            break
+            queue_time = max(queue_item_entry_time, serving_counter_item_issue_time)
+
+            # if time in queue has not exceeded expiry period, we can stop checking
+            if current_time - queue_time < QUEUE_POSITION_EXPIRY_PERIOD:
+                break
                 
-        # set max queue position to serving counter item position
-        if rc.set(MAX_QUEUE_POSITION_EXPIRED, serving_counter_item_position):
-            max_queue_position_expired = serving_counter_item_position
-            print(f'Max queue expiry position set to: {max_queue_position_expired}')
-        else:
-            print(f'Failed to set max queue position served: Current value: {max_queue_position_expired}')
+            increment_by = 0
+            if INCR_SVC_ON_QUEUE_POS_EXPIRY:
+                increment_by = get_serving_counter_increment(queue_positions_served, serving_counter_item_position, previous_serving_counter_position)
+
+            # set max queue position to serving counter item position and increment the serving counter
+            # in one transaction so the two counters can't drift apart
+            with rc.pipeline(transaction=True) as pipe:
+                pipe.set(MAX_QUEUE_POSITION_EXPIRED, serving_counter_item_position)
+                if increment_by > 0:
+                    pipe.incrby(SERVING_COUNTER, increment_by)
+                results = pipe.execute()
+
+            if results[0]:
+                max_queue_position_expired = serving_counter_item_position
+                print(f'Max queue expiry position set to: {max_queue_position_expired}')
+            else:
+                print(f'Failed to set max queue position served: Current value: {max_queue_position_expired}')
+
+            if increment_by > 0:
+                record_serving_counter_incr(int(results[1]), increment_by, current_time, event_entries)
+                if len(event_entries) >= MAX_EVENT_ENTRIES:
+                    flush_events(event_entries)
+
+            # set prevous serving counter position to item serving counter position for the loop
+            previous_serving_counter_position = serving_counter_item_position
+    finally:
+        # send the events for increments already made, even if a later iteration failed
+        flush_events(event_entries)
+
+
+def flush_events(event_entries):
+    """
+    Function to send and clear the pending serving counter increment events, logging any entries EventBridge rejected
+    """
+    if EMIT_COUNTER_EVENTS and event_entries:
+        response = events_client.put_events(Entries=list(event_entries))
+        if response.get('FailedEntryCount'):
+            failed_entries = [
+                (entry, result) for entry, result in zip(event_entries, response['Entries']) if 'ErrorCode' in result
+            ]
+            print(f'Failed to put {response["FailedEntryCount"]} events: {failed_entries}')
+    event_entries.clear()
 
-        if INCR_SVC_ON_QUEUE_POS_EXPIRY == 'true':
-            queue_positions_served = int(serving_counter_item['queue_positions_served'])
-            incr_serving_counter(rc, queue_positions_served, serving_counter_item_position, previous_serving_counter_position)
 
-        # set prevous serving counter position to item serving counter position for the loop
-        previous_serving_counter_position = serving_counter_item_position
+def with_queue_entry_times(serving_counter_entries):
+    """
+    Generator pairing each serving counter entry with its queue position entry time; positions are queried
+    concurrently in ordered windows of MAX_QUERY_WORKERS, so a loop that stops early skips the remaining queries
+    """
+    with ThreadPoolExecutor(max_workers=MAX_QUERY_WORKERS) as executor:
+        for index in range(0, len(serving_counter_entries), MAX_QUERY_WORKERS):
+            window = serving_counter_entries[index:index + MAX_QUERY_WORKERS]
+            yield from zip(window, executor.map(get_queue_position_entry_time, [entry[0] for entry in window]))
 
 
-def incr_serving_counter(rc, queue_positions_served, serving_counter_item_position, previous_serving_counter_position):
+def get_queue_position_entry_time(queue_position):
     """
-    Function to increment the serving counter based on queue postions served (indirectly expired positions)
+    Function to get the entry time of a queue position, or None if the position has no entry
+    """
+    response = ddb_client.query(
+        **QUEUE_POSITION_QUERY,
+        ExpressionAttributeValues={':queue_position': {'N': str(queue_position)}}
+    )
+    queue_position_items = response['Items']
+    if not queue_position_items:
+        return None
+    return int(queue_position_items[0]['entry_time']['N'])
+
+
+def get_serving_counter_increment(queue_positions_served, serving_counter_item_position, previous_serving_counter_position):
+    """
+    Function to calculate the serving counter increment based on queue postions served (indirectly expired positions)
     """
     # increment the serving counter by taking the difference of counter item entries and subtract positions served in that range
     # [(Current counter - Previous counter) - (Queue positions served in that range)]
@@ -116,32 +203,36 @@ def incr_serving_counter(rc, queue_positions_served, serving_counter_item_positi
     # should never happen, addl guard
     if increment_by <= 0:
         print(f'Increment value calculated as {increment_by}, incrementing serving counter skipped')
-        return
+        return 0
+
+    return increment_by
+
 
-    cur_serving = int(rc.incrby(SERVING_COUNTER, int(increment_by)))
+def record_serving_counter_incr(cur_serving, increment_by, issue_time, event_entries):
+    """
+    Function to record an automatic serving counter increment in DynamoDB and append its event to event_entries
+    """
     item = {
-        'event_id': EVENT_ID,
-        'serving_counter': cur_serving,
-        'issue_time': int(time()),
-        'queue_positions_served': 0
+        'event_id': {'S': EVENT_ID},
+        'serving_counter': {'N': str(cur_serving)},
+        'issue_time': {'N': str(issue_time)},
+        'queue_positions_served': {'N': '0'}
     }
-    ddb_table_serving_counter_issued_at.put_item(Item=item)
+    ddb_client.put_item(TableName=SERVING_COUNTER_ISSUEDAT_TABLE, Item=item)
     print(f'Item: {item}')
     print(f'Serving counter incremented by {increment_by}. Current value: {cur_serving}')
 
-    events_client.put_events(
-        Entries=[
-            {
-                'Source': 'custom.waitingroom',
-                'DetailType': 'automatic_serving_counter_incr',
-                'Detail': json.dumps(
-                    {
-                        'previous_serving_counter_position': cur_serving - increment_by,
-                        'increment_by': increment_by,
-                        'current_serving_counter_position': cur_serving,
-                    }
-                ),
-                'EventBusName': EVENT_BUS_NAME
-            }
-        ]
+    event_entries.append(
+        {
+            'Source': 'custom.waitingroom',
+            'DetailType': 'automatic_serving_counter_incr',
+            'Detail': json.dumps(
+                {
+                    'previous_serving_counter_position': cur_serving - increment_by,
+                    'increment_by': increment_by,
+                    'current_serving_counter_position': cur_serving,
+                }
+            ),
+            'EventBusName': EVENT_BUS_NAME
+        }
     )